@@ -1,17 +1,30 @@
 import argparse
+import atexit
 import datetime
+import functools
+import hashlib
 import json
 import logging
+import logging.handlers
 import os
+import queue
 import re
+import selectors
+import shlex
 import shutil
+import signal
 import subprocess
 import tempfile
 import textwrap
-from collections.abc import Generator
+import threading
+from collections import deque
+from collections.abc import Generator, Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
 from subprocess import CompletedProcess
+from types import FrameType
 from typing import TYPE_CHECKING
 
 from . import __version__
@@ -26,7 +39,122 @@ except ImportError:
 if TYPE_CHECKING and not GITLAB_IMPORTED:
     import gitlab
 
-logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+try:
+    import msgspec
+
+    MSGSPEC_IMPORTED = True
+except ImportError:
+    MSGSPEC_IMPORTED = False
+
+BRANCH_RE = re.compile(r"^update-mirrors/([^/]+)/(\d+)$")
+GIT_COMMAND = ("git", "-c", "credential.interactive=false")
+STOP_EVENT = threading.Event()
+PROCESS_LOCK = threading.RLock()
+ACTIVE_PROCESSES: set[subprocess.Popen[bytes]] = set()
+# bst-to-lorry writes into the shared git and raw files directories and
+# different repositories can produce the same lorry file
+BST_TO_LORRY_LOCK = threading.Lock()
+
+
+class CommandString:
+    def __init__(self, command: Sequence[str]) -> None:
+        self.command = command
+
+    def __str__(self) -> str:
+        return shlex.join(self.command)
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    base_branch: str
+    git_dir: str
+    raw_files_dir: str
+    exclude_aliases: tuple[str, ...]
+    lorry2: bool
+    cache_dir: str
+    sparse_paths: tuple[str, ...]
+    jobs: int = 1
+    fail_fast: bool = False
+    scratch_dir: str | None = None
+    alternate: str | None = None
+    gitlab_token: str | None = None
+    gitlab_project_id: str | None = None
+    gitlab_url: str | None = None
+
+
+def setup_logging() -> None:
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+        force=True,
+    )
+    listener.start()
+    atexit.register(listener.stop)
+
+
+def open_pidfd(pid: int) -> int | None:
+    if not hasattr(os, "pidfd_open"):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def append_lines(buffer: bytearray, chunk: bytes, tail: deque[str]) -> None:
+    buffer += chunk
+    *lines, rest = buffer.split(b"\n")
+    for line in lines:
+        text = line.decode("utf-8", errors="replace")
+        logging.debug("%s", text)
+        tail.append(f"{text}\n")
+    buffer[:] = rest
+
+
+def read_output(proc: subprocess.Popen[bytes], tail: deque[str]) -> bytes:
+    stdout = bytearray()
+    stderr_line = bytearray()
+    pidfd = open_pidfd(proc.pid)
+    timeout: float | None = None
+    try:
+        with selectors.DefaultSelector() as selector:
+            for stream in (proc.stdout, proc.stderr):
+                if stream is not None:
+                    selector.register(stream, selectors.EVENT_READ)
+            if pidfd is not None:
+                selector.register(pidfd, selectors.EVENT_READ)
+
+            while any(key.fd != pidfd for key in selector.get_map().values()):
+                events = selector.select(timeout)
+                if not events:
+                    break
+                for key, _ in events:
+                    if key.fd == pidfd:
+                        # The child has exited, only drain what is left
+                        # instead of waiting on pipes held open by its
+                        # own children
+                        selector.unregister(pidfd)
+                        timeout = 0
+                        continue
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                    elif key.fileobj is proc.stdout:
+                        stdout += chunk
+                    else:
+                        append_lines(stderr_line, chunk, tail)
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+    if stderr_line:
+        append_lines(stderr_line, b"\n", tail)
+    return bytes(stdout)
 
 
 def run_command(
@@ -37,87 +165,128 @@ def run_command(
     message: str | None = None,
     warn: bool = False,
 ) -> CompletedProcess[str]:
-    try:
-        return subprocess.run(
+    stderr_tail: deque[str] = deque(maxlen=100)
+    with PROCESS_LOCK:
+        # Nothing new is started once a signal was received
+        if STOP_EVENT.is_set():
+            raise subprocess.CalledProcessError(-signal.SIGTERM, command)
+        proc = subprocess.Popen(
             command,
-            check=check,
             stdout=subprocess.PIPE if capture_output else subprocess.DEVNULL,
-            stderr=subprocess.PIPE if capture_output else subprocess.DEVNULL,
-            text=True,
+            stderr=subprocess.PIPE,
             cwd=cwd,
         )
-    except subprocess.CalledProcessError as e:
-        if message and warn:
-            logging.warning("%s: %s", message, e.stderr.strip() if e.stderr else "")
-        elif message and not warn:
-            logging.error("%s: %s", message, e.stderr.strip() if e.stderr else "")
-        else:
-            logging.error(
-                "Command failed: %s\nError: %s",
-                " ".join(command),
-                e.stderr.strip() if e.stderr else "",
-            )
-        raise
-
-
-def element_exists(element: str, path: str) -> bool:
+        ACTIVE_PROCESSES.add(proc)
+    try:
+        with proc:
+            output = read_output(proc, stderr_tail)
+            returncode = proc.wait()
+    finally:
+        with PROCESS_LOCK:
+            ACTIVE_PROCESSES.discard(proc)
+
+    stdout = output.decode("utf-8", errors="replace") if capture_output else None
+    stderr = "".join(stderr_tail)
+    if not check or not returncode:
+        return CompletedProcess(command, returncode, stdout, stderr)
+
+    error = stderr.strip()
+    if message and warn:
+        logging.warning("%s: %s", message, error)
+    elif message and not warn:
+        logging.error("%s: %s", message, error)
+    else:
+        logging.error("Command failed: %s\nError: %s", CommandString(command), error)
+    raise subprocess.CalledProcessError(returncode, command, stdout, stderr)
+
+
+def show_elements(elements: list[str], path: str, warn: bool = False) -> bool:
     command = [
         "bst",
         "--no-interactive",
+        "--directory",
+        path,
         "show",
         "--deps",
         "none",
         "-f",
         "%{name}",
-        element,
+        *elements,
     ]
     try:
         run_command(
             command,
-            cwd=path,
-            message=f"Did not find element: {element}",
-            warn=True,
+            message=f"Did not find elements: {', '.join(elements)}",
+            warn=warn,
         )
         return True
     except subprocess.CalledProcessError:
         return False
 
 
+def find_missing_elements(elements: list[str], path: str) -> list[str]:
+    if show_elements(elements, path, warn=True):
+        return []
+    if len(elements) == 1:
+        return elements
+    return [elem for elem in elements if not show_elements([elem], path, warn=True)]
+
+
 def run_git(
     args: list[str],
     repo_path: str | None = None,
     capture_output: bool = False,
     message: str | None = None,
     warn: bool = False,
+    check: bool = True,
 ) -> CompletedProcess[str]:
-    if repo_path is None:
-        repo_path = str(Path.cwd())
-    command = ["git", "-c", "credential.interactive=false", "-C", repo_path, *args]
-    logging.info("Running command: %s", " ".join(command))
+    location = ["-C", repo_path] if repo_path is not None else []
+    command = [*GIT_COMMAND, *location, *args]
+    logging.info("Running command: %s", CommandString(command))
     return run_command(
-        command, capture_output=capture_output, message=message, warn=warn
+        command,
+        check=check,
+        capture_output=capture_output,
+        message=message,
+        warn=warn,
     )
 
 
-def is_cmd_present(cmd: str) -> bool:
-    return shutil.which(cmd) is not None
+@functools.cache
+def find_command(cmd: str, path: str) -> str | None:
+    return shutil.which(cmd, path=path)
 
 
-def is_git_dir(path: str | None = None) -> bool:
-    try:
-        run_git(["rev-parse"], path, message="Not a git repository")
-        return True
-    except subprocess.CalledProcessError:
-        return False
+def is_cmd_present(cmd: str) -> bool:
+    # Keyed on PATH as well so that a changed PATH is searched again
+    return find_command(cmd, os.environ.get("PATH", os.defpath)) is not None
 
 
-def is_dirty(repo_path: str | None = None, subdir: str | None = None) -> bool:
+def is_dirty(repo_path: str | None = None, *subdirs: str) -> bool:
+    # ":/" is the top of the worktree, so that running from a
+    # subdirectory still checks the whole repository
+    pathspec = ["--", *(subdirs or (":/",))]
     try:
-        args = ["status", "--porcelain"]
-        if subdir:
-            args += ["--", subdir]
+        result = run_git(["diff", "--quiet", "HEAD", *pathspec], repo_path, check=False)
+        if result.returncode != 0:
+            if result.returncode != 1:
+                logging.error("Failed to check git status: %s", result.stderr.strip())
+            return True
+
+        # git diff does not see untracked files, such as newly added
+        # lorry files
         result = run_git(
-            args, repo_path, capture_output=True, message="Failed to check git status"
+            [
+                "ls-files",
+                "--others",
+                "--exclude-standard",
+                "--directory",
+                "--no-empty-directory",
+                *pathspec,
+            ],
+            repo_path,
+            capture_output=True,
+            message="Failed to check git status",
         )
         return bool(result.stdout.strip())
     except subprocess.CalledProcessError:
@@ -165,57 +334,227 @@ def get_toplevel(path: str | None = None) -> str | None:
         return None
 
 
-def validate_environment() -> bool:
-    validations = [
-        (is_cmd_present("git"), "Unable to find git in PATH"),
-        (is_cmd_present("bst"), "Unable to find bst-to-lorry in PATH"),
-        (is_cmd_present("bst-to-lorry"), "Unable to find auto_updater in PATH"),
-        (is_git_dir(), "Current directory is not a git repository"),
-        (not is_dirty(), "Current repository checkout is dirty"),
-    ]
-    for valid, msg in validations:
-        if not valid:
-            logging.error(msg)
-            return False
-    return True
+def validate_environment() -> str | None:
+    for cmd in ("git", "bst", "bst-to-lorry"):
+        if not is_cmd_present(cmd):
+            logging.error("Unable to find %s in PATH", cmd)
+            return None
+
+    toplevel = get_toplevel()
+    if toplevel is None:
+        logging.error("Current directory is not a git repository")
+        return None
+
+    if is_dirty():
+        logging.error("Current repository checkout is dirty")
+        return None
+
+    return toplevel
+
+
+def is_valid_mirror_config(config: object) -> bool:
+    return isinstance(config, dict) and all(
+        isinstance(branches, dict)
+        and all(
+            isinstance(elements, list) and all(isinstance(e, str) for e in elements)
+            for elements in branches.values()
+        )
+        for branches in config.values()
+    )
+
+
+def decode_mirror_config(data: bytes) -> dict[str, dict[str, list[str]]]:
+    if MSGSPEC_IMPORTED:
+        try:
+            return msgspec.json.decode(data, type=dict[str, dict[str, list[str]]])
+        except msgspec.DecodeError as e:
+            raise ValueError(e) from e
+
+    config: dict[str, dict[str, list[str]]] = json.loads(data)
+    if not is_valid_mirror_config(config):
+        raise ValueError("Expected a mapping of repository URLs to branch elements")
+    return config
 
 
 def load_mirror_config(file: str) -> dict[str, dict[str, list[str]]]:
     try:
-        with open(file, encoding="utf-8") as f:
-            config: dict[str, dict[str, list[str]]] = json.load(f)
+        with open(file, "rb") as f:
+            config = decode_mirror_config(f.read())
         logging.info("Loaded mirror configuration from %s", file)
         return config
     except FileNotFoundError:
         logging.error("Mirror configuration file not found: %s", file)
         raise
-    except json.JSONDecodeError as e:
-        logging.error("Invalid JSON in mirror configuration file: %s", e)
+    except ValueError as e:
+        logging.error("Invalid mirror configuration file: %s", e)
         raise
 
 
+def get_default_cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+    return str(Path(cache_home) / "lorry-mirror-updater")
+
+
+def get_cache_path(url: str, cache_dir: str) -> Path:
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return Path(cache_dir) / f"{digest}.git"
+
+
+def get_objects_dir(repo_path: str) -> str | None:
+    try:
+        result = run_git(
+            ["rev-parse", "--path-format=absolute", "--git-path", "objects"],
+            repo_path,
+            capture_output=True,
+            message=f"Failed to find the object directory of {repo_path}",
+            warn=True,
+        )
+        return result.stdout.strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def update_cache(
+    url: str, cache_path: Path, branches: list[str], alternate: str | None = None
+) -> bool:
+    created = not cache_path.is_dir()
+    refspecs = [f"+refs/heads/{branch}:refs/heads/{branch}" for branch in branches]
+    try:
+        if created:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            run_git(
+                ["init", "--bare", str(cache_path)],
+                message=f"Failed to create cache for repository: {url}",
+            )
+            run_git(
+                ["remote", "add", "origin", url],
+                str(cache_path),
+                message=f"Failed to add remote for repository: {url}",
+            )
+            if alternate:
+                # Same as git clone --reference, objects already present
+                # in the alternate are not fetched again
+                alternates = cache_path / "objects" / "info" / "alternates"
+                with open(alternates, "a", encoding="utf-8") as f:
+                    f.write(f"{alternate}\n")
+                logging.info("Borrowing objects of %s from %s", url, alternate)
+        # Protocol v2 lets the server advertise only the refs asked for
+        # instead of every ref in the repository
+        run_git(
+            [
+                "-c",
+                "protocol.version=2",
+                "fetch",
+                "--filter=blob:none",
+                "--depth=1",
+                "--prune",
+                "origin",
+                *refspecs,
+            ],
+            str(cache_path),
+            message=f"Failed to fetch repository: {url}",
+        )
+        logging.info("Fetched %s of %s into %s", branches, url, cache_path)
+        return True
+    except subprocess.CalledProcessError:
+        if created:
+            shutil.rmtree(cache_path, ignore_errors=True)
+        return False
+
+
+def load_element_cache(path: Path) -> dict[str, dict[str, list[str]]]:
+    # Maps repository URLs to commits and the elements verified at them,
+    # which is the same shape as the mirror configuration
+    try:
+        with open(path, "rb") as f:
+            return decode_mirror_config(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_element_cache(path: Path, cache: dict[str, dict[str, list[str]]]) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2)
+            f.write("\n")
+        tmp_path.replace(path)
+    except OSError as e:
+        logging.warning("Failed to write element cache %s: %s", path, e)
+
+
+def add_worktree(
+    cache_path: Path, dest_path: Path, ref: str, sparse_paths: Sequence[str]
+) -> bool:
+    args = ["worktree", "add", "--detach", str(dest_path), ref]
+    if sparse_paths:
+        args.insert(2, "--no-checkout")
+    try:
+        run_git(
+            ["worktree", "prune"],
+            str(cache_path),
+            message=f"Failed to prune worktrees of {cache_path}",
+        )
+        run_git(
+            args,
+            str(cache_path),
+            message=f"Failed to create worktree {dest_path}",
+        )
+        if sparse_paths:
+            run_git(
+                ["sparse-checkout", "set", "--cone", "--", *sparse_paths],
+                str(dest_path),
+                message=f"Failed to set up sparse checkout in {dest_path}",
+            )
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+
+def remove_worktree(cache_path: Path, dest_path: Path) -> bool:
+    try:
+        run_git(
+            ["worktree", "remove", "--force", str(dest_path)],
+            str(cache_path),
+            message=f"Failed to remove worktree {dest_path}",
+            warn=True,
+        )
+        return True
+    except subprocess.CalledProcessError:
+        return False
+
+
 @contextmanager
-def clone_repo(url: str) -> Generator[tuple[bool, str | None], None, None]:
-    with tempfile.TemporaryDirectory() as tmpdir:
+def clone_repo(
+    url: str, branches: list[str], config: Config
+) -> Generator[tuple[bool, str | None], None, None]:
+    cache_path = get_cache_path(url, config.cache_dir)
+    if not update_cache(url, cache_path, branches, config.alternate):
+        yield False, None
+        return
+
+    with tempfile.TemporaryDirectory(dir=config.scratch_dir) as tmpdir:
         repo_name = url.split("/")[-1].replace(".git", "")
         dest_path = Path(tmpdir) / repo_name
 
-        try:
-            run_git(
-                ["clone", url, str(dest_path)],
-                message=f"Failed to clone repository: {url}",
-            )
-            logging.info("Cloned %s to %s", url, dest_path)
-            yield True, str(dest_path)
-        except subprocess.CalledProcessError:
+        if not add_worktree(cache_path, dest_path, branches[0], config.sparse_paths):
             yield False, None
             return
 
+        logging.info("Checked out %s to %s", url, dest_path)
+        try:
+            yield True, str(dest_path)
+        finally:
+            remove_worktree(cache_path, dest_path)
+
 
-def checkout_branch(branch: str, repo_path: str | None = None) -> bool:
+def checkout_branch(
+    branch: str, repo_path: str | None = None, detach: bool = False
+) -> bool:
     try:
         run_git(
-            ["checkout", branch],
+            ["checkout", "--detach", branch] if detach else ["checkout", branch],
             repo_path,
             message=f"Failed to checkout branch: {branch}",
         )
@@ -225,6 +564,19 @@ def checkout_branch(branch: str, repo_path: str | None = None) -> bool:
         return False
 
 
+def resolve_branches(branches: list[str], repo_path: str) -> list[str] | None:
+    try:
+        result = run_git(
+            ["rev-parse", *(f"refs/heads/{branch}" for branch in branches)],
+            repo_path,
+            capture_output=True,
+            message=f"Failed to resolve branches: {branches}",
+        )
+        return result.stdout.split()
+    except subprocess.CalledProcessError:
+        return None
+
+
 def create_branch(base_branch: str) -> str | None:
     timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d%H%M%S")
     branch_name = f"update-mirrors/{base_branch}/{timestamp}"
@@ -243,7 +595,7 @@ def run_bst_to_lorry(
     elements: list[str],
     git_dir: str,
     raw_files_dir: str,
-    exclude_aliases: list[str],
+    exclude_aliases: Sequence[str],
     cwd: str,
     lorry2: bool = False,
 ) -> bool:
@@ -262,7 +614,7 @@ def run_bst_to_lorry(
     for alias in exclude_aliases:
         command.extend(["--exclude-alias", alias])
 
-    logging.info("Running bst-to-lorry: %s", " ".join(command))
+    logging.info("Running bst-to-lorry: %s", CommandString(command))
     try:
         run_command(command, cwd=cwd, message="bst-to-lorry failed")
         return True
@@ -275,10 +627,8 @@ def process_branch(
     branch: str,
     elements: list[str],
     clone_dest: str,
-    git_dir: str,
-    raw_files_dir: str,
-    exclude_aliases: list[str],
-    lorry2: bool,
+    config: Config,
+    check_elements: bool = True,
 ) -> bool:
     logging.info(
         "Processing branch: %s of repo %s with elements: %s",
@@ -287,27 +637,35 @@ def process_branch(
         elements,
     )
 
-    if not checkout_branch(branch, str(clone_dest)):
+    if not checkout_branch(branch, str(clone_dest), detach=True):
         return False
 
-    missing_elements = [
-        elem for elem in elements if not element_exists(elem, str(clone_dest))
-    ]
-
-    if missing_elements:
-        logging.error(
-            "Required elements not found in branch %s of repo %s: %s",
-            branch,
-            repo_url,
-            missing_elements,
-        )
-        return False
+    if check_elements:
+        missing_elements = find_missing_elements(elements, str(clone_dest))
 
-    logging.info("All required elements found in branch %s: %s", branch, elements)
+        if missing_elements:
+            logging.error(
+                "Required elements not found in branch %s of repo %s: %s",
+                branch,
+                repo_url,
+                missing_elements,
+            )
+            return False
 
-    if not run_bst_to_lorry(
-        elements, git_dir, raw_files_dir, exclude_aliases, clone_dest, lorry2
-    ):
+        logging.info("All required elements found in branch %s: %s", branch, elements)
+    else:
+        logging.info("Elements already verified in branch %s: %s", branch, elements)
+
+    with BST_TO_LORRY_LOCK:
+        status = run_bst_to_lorry(
+            elements,
+            config.git_dir,
+            config.raw_files_dir,
+            config.exclude_aliases,
+            clone_dest,
+            config.lorry2,
+        )
+    if not status:
         logging.error("bst-to-lorry failed for branch %s in repo %s", branch, repo_url)
         return False
 
@@ -317,32 +675,53 @@ def process_branch(
 def process_repo(
     repo_url: str,
     repo_config: dict[str, list[str]],
-    git_dir: str,
-    raw_files_dir: str,
-    exclude_aliases: list[str],
-    base_branch: str,
-    lorry2: bool,
+    config: Config,
+    element_cache: dict[str, dict[str, list[str]]],
 ) -> bool:
-    with clone_repo(repo_url) as (clone_status, clone_dest):
+    if not repo_config:
+        return True
+
+    branches = list(repo_config)
+    with clone_repo(repo_url, branches, config) as (clone_status, clone_dest):
         if not clone_status or clone_dest is None:
             return False
 
-        if not checkout_branch(base_branch):
+        commits = resolve_branches(branches, clone_dest)
+        if commits is None:
             return False
 
-        for branch, config_elements in repo_config.items():
+        # Branches pointing at the same commit share a single bst run
+        targets: dict[str, tuple[str, list[str]]] = {}
+        for (branch, config_elements), commit in zip(
+            repo_config.items(), commits, strict=True
+        ):
+            target_branch, elements = targets.setdefault(commit, (branch, []))
+            if target_branch != branch:
+                logging.info(
+                    "Branch %s of repo %s is at the same commit as %s",
+                    branch,
+                    repo_url,
+                    target_branch,
+                )
+            elements.extend(e for e in config_elements if e not in elements)
+
+        known_elements = element_cache.get(repo_url, {})
+        verified_elements: dict[str, list[str]] = {}
+        for commit, (branch, elements) in targets.items():
             if not process_branch(
                 repo_url,
                 branch,
-                config_elements,
+                elements,
                 clone_dest,
-                git_dir,
-                raw_files_dir,
-                exclude_aliases,
-                lorry2,
+                config,
+                check_elements=not set(elements).issubset(
+                    known_elements.get(commit, [])
+                ),
             ):
                 return False
+            verified_elements[commit] = elements
 
+    element_cache[repo_url] = verified_elements
     return True
 
 
@@ -359,64 +738,99 @@ def commit_changes(
 
 
 def process_mirroring(
-    mirror_config: dict[str, dict[str, list[str]]],
-    git_dir: str,
-    raw_files_dir: str,
-    exclude_aliases: list[str],
-    base_branch: str,
-    lorry2: bool,
+    mirror_config: dict[str, dict[str, list[str]]], config: Config
 ) -> tuple[bool, str | None]:
-    for repo_url, repo_config in mirror_config.items():
-        if not process_repo(
-            repo_url,
-            repo_config,
-            git_dir,
-            raw_files_dir,
-            exclude_aliases,
-            base_branch,
-            lorry2,
-        ):
+    if not checkout_branch(config.base_branch):
+        return False, None
+
+    element_cache_path = Path(config.cache_dir) / "elements.json"
+    element_cache = {
+        repo_url: commits
+        for repo_url, commits in load_element_cache(element_cache_path).items()
+        if repo_url in mirror_config
+    }
+    failed_repos: list[str] = []
+    try:
+        with ThreadPoolExecutor(max_workers=config.jobs) as executor:
+            futures = {
+                executor.submit(
+                    process_repo, repo_url, repo_config, config, element_cache
+                ): repo_url
+                for repo_url, repo_config in mirror_config.items()
+            }
+            try:
+                for future in as_completed(futures):
+                    repo_url = futures[future]
+                    try:
+                        if future.result():
+                            continue
+                        logging.error("Failed to process repo: %s", repo_url)
+                    except Exception:
+                        logging.exception("Failed to process repo: %s", repo_url)
+                    failed_repos.append(repo_url)
+                    if config.fail_fast:
+                        executor.shutdown(cancel_futures=True)
+                        return False, None
+            except BaseException:
+                # Interrupted by a signal, do not start the queued repos
+                # and wait for the running ones to unwind
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        save_element_cache(element_cache_path, element_cache)
+
+    if failed_repos:
+        if len(failed_repos) == len(mirror_config):
+            logging.error("Failed to process all repos")
             return False, None
+        logging.warning(
+            "Continuing with the remaining repos, failed to process: %s",
+            failed_repos,
+        )
 
-    if is_dirty(subdir=raw_files_dir) or is_dirty(subdir=git_dir):
-        return commit_changes(git_dir, raw_files_dir, base_branch)
+    if is_dirty(None, config.raw_files_dir, config.git_dir):
+        return commit_changes(config.git_dir, config.raw_files_dir, config.base_branch)
 
     logging.warning("Nothing to commit")
     return True, None
 
 
+def delete_branch(project: "gitlab.v4.objects.Project", branch: str) -> None:
+    logging.info("Deleting branch: %s", branch)
+    project.branches.delete(branch)
+
+
 def cleanup_branches(
     project: "gitlab.v4.objects.Project",
-    branch_regex: str = r"^update-mirrors/([^/]+)/(\d+)$",
+    branch_regex: re.Pattern[str] = BRANCH_RE,
 ) -> None:
-    branches = project.branches.list(iterator=True, regex=branch_regex)
+    branches = project.branches.list(iterator=True, regex=branch_regex.pattern)
     open_mrs = project.mergerequests.list(state="opened", iterator=True)
     branch_names = {branch.name for branch in branches}
     open_mr_branches = {
-        mr.source_branch for mr in open_mrs if re.match(branch_regex, mr.source_branch)
+        mr.source_branch for mr in open_mrs if branch_regex.match(mr.source_branch)
     }
     branches_without_open_mrs = branch_names - open_mr_branches
     project.delete_merged_branches()
-    for branch in branches_without_open_mrs:
-        logging.info("Deleting branch: %s", branch)
-        project.branches.delete(branch)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(
+            executor.map(
+                functools.partial(delete_branch, project), branches_without_open_mrs
+            )
+        )
 
 
 def create_merge_request(
     source_branch: str,
-    base_branch: str,
+    config: Config,
     mr_title: str = "(Automated) Update mirrors",
     clear_br: bool = True,
 ) -> bool:
-    token = os.environ.get("GITLAB_API_KEY") or os.environ.get("FREEDESKTOP_API_TOKEN")
-    if not token:
+    if not config.gitlab_token:
         logging.error("GITLAB_API_KEY is not defined")
         return False
 
-    if not (
-        (project_id := os.environ.get("CI_PROJECT_ID"))
-        and (gitlab_url := os.environ.get("CI_SERVER_URL"))
-    ):
+    if not (config.gitlab_project_id and config.gitlab_url):
         logging.error(
             "CI_PROJECT_ID or CI_SERVER_URL is not defined. "
             "Likely running outside of GitLab pipeline"
@@ -424,12 +838,12 @@ def create_merge_request(
         return False
 
     try:
-        gl = gitlab.Gitlab(gitlab_url, private_token=token)
-        project = gl.projects.get(project_id, lazy=True)
+        gl = gitlab.Gitlab(config.gitlab_url, private_token=config.gitlab_token)
+        project = gl.projects.get(config.gitlab_project_id, lazy=True)
         mr = project.mergerequests.create(
             {
                 "source_branch": source_branch,
-                "target_branch": base_branch,
+                "target_branch": config.base_branch,
                 "title": mr_title,
             }
         )
@@ -456,7 +870,19 @@ def push_branch_to_remote(branch: str, remote: str = "origin") -> bool:
         return False
 
 
+def cleanup_and_exit(signum: int, _frame: FrameType | None) -> None:
+    # Checkouts are removed by the workers once their commands have
+    # been terminated, not here while they may still be in use
+    with PROCESS_LOCK:
+        STOP_EVENT.set()
+        for proc in ACTIVE_PROCESSES:
+            logging.info("Terminating process %d", proc.pid)
+            proc.terminate()
+    raise SystemExit(128 + signum)
+
+
 def main() -> int:
+    setup_logging()
     default_git_dir = "gits"
     default_raw_files_dir = "files"
     description = textwrap.dedent("""\
@@ -531,42 +957,115 @@ def main() -> int:
         action="store_true",
         help="Use lorry2 format in bst-to-lorry",
     )
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        metavar="",
+        help=(
+            "Number of repositories to process in parallel, "
+            "bst-to-lorry itself runs one at a time (default: 1)"
+        ),
+    )
+    parser.add_argument(
+        "--fail-fast",
+        default=False,
+        action="store_true",
+        help="Stop at the first repository that fails to process",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=get_default_cache_dir(),
+        metavar="",
+        help=(
+            "Path to the directory holding cached clones "
+            "(default: $XDG_CACHE_HOME/lorry-mirror-updater)"
+        ),
+    )
+    parser.add_argument(
+        "--reference",
+        default=None,
+        metavar="",
+        help=(
+            "Path to a local repository to borrow objects from when adding "
+            "repositories to the cache. It must be kept alongside the cache"
+        ),
+    )
+    parser.add_argument(
+        "--scratch-dir",
+        default=None,
+        metavar="",
+        help=(
+            "Path to the directory for temporary checkouts, "
+            "for example a tmpfs (default: system temporary directory)"
+        ),
+    )
+    parser.add_argument(
+        "--sparse-checkout",
+        type=str,
+        metavar="",
+        default="",
+        help=(
+            "Comma separated list of directories to check out instead of the full tree"
+        ),
+    )
     args = parser.parse_args()
 
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, cleanup_and_exit)
+
+    if args.jobs < 1:
+        logging.error("--jobs must be at least 1")
+        return 1
+
+    if args.scratch_dir is not None and not Path(args.scratch_dir).is_dir():
+        logging.error("--scratch-dir %s is not a directory", args.scratch_dir)
+        return 1
+
     if args.create_mr:
         args.push = True
         if not GITLAB_IMPORTED:
             logging.error("--create-mr is used but python-gitlab was not imported")
             return 1
 
-    if not validate_environment():
+    git_toplevel = validate_environment()
+    if not git_toplevel:
         return 1
 
     try:
         mirror_config = load_mirror_config(args.mirror_config)
-    except (FileNotFoundError, json.JSONDecodeError):
+    except (FileNotFoundError, ValueError):
         return 1
 
-    git_toplevel = get_toplevel()
-    if not git_toplevel:
-        logging.error("Failed to determine the top-level git directory")
-        return 1
-
-    default_git_dir = str(Path(git_toplevel) / "gits")
-    default_raw_files_dir = str(Path(git_toplevel) / "files")
-    args.git_directory = default_git_dir
-    args.raw_files_directory = default_raw_files_dir
-    exclude_aliases = [s.strip() for s in args.exclude_alias.split(",") if s.strip()]
-
-    status, branch = process_mirroring(
-        mirror_config,
-        args.git_directory,
-        args.raw_files_directory,
-        exclude_aliases,
-        args.base_branch,
-        args.lorry2,
+    alternate = get_objects_dir(args.reference) if args.reference else None
+    if args.reference and not alternate:
+        logging.warning("Not using %s as a reference repository", args.reference)
+
+    config = Config(
+        base_branch=args.base_branch,
+        git_dir=str(Path(git_toplevel) / "gits"),
+        raw_files_dir=str(Path(git_toplevel) / "files"),
+        exclude_aliases=tuple(
+            s.strip() for s in args.exclude_alias.split(",") if s.strip()
+        ),
+        lorry2=args.lorry2,
+        cache_dir=args.cache_dir,
+        sparse_paths=tuple(
+            s.strip() for s in args.sparse_checkout.split(",") if s.strip()
+        ),
+        jobs=args.jobs,
+        fail_fast=args.fail_fast,
+        scratch_dir=args.scratch_dir,
+        alternate=alternate,
+        gitlab_token=(
+            os.environ.get("GITLAB_API_KEY") or os.environ.get("FREEDESKTOP_API_TOKEN")
+        ),
+        gitlab_project_id=os.environ.get("CI_PROJECT_ID"),
+        gitlab_url=os.environ.get("CI_SERVER_URL"),
     )
 
+    status, branch = process_mirroring(mirror_config, config)
+
     if status is False and branch is None:
         return 1
 
@@ -578,7 +1077,7 @@ def main() -> int:
             GITLAB_IMPORTED
             and args.create_mr
             and push_ret
-            and not create_merge_request(branch, args.base_branch)
+            and not create_merge_request(branch, config)
         ):
             return 1
 